@@ -5,6 +5,8 @@ import subprocess
 import tempfile
 import os
 import traceback
+import time
+from recorder import recorder
 
 class BlocompRunner:
     TIMEOUT_SECONDS = 2
@@ -19,28 +21,31 @@ class BlocompRunner:
             prefix = m.group(1)
             problem_id = m.group(2)
             problem_url = f'{prefix}problems/{problem_id}.json'
-            response = requests.get(problem_url)
+            response = recorder.http(requests.request, 'GET', problem_url)
             response.raise_for_status()
             return response.json()
         else:
             raise Exception('Could not find problem id in assignment URL')
 
-    def evaluate(self, answer):
+    def evaluate(self, answer, timeout_seconds=None):
         if not 'testCases' in self.problem["problem"]:
             self.problem["problem"]["testCases"] = [{"input": ""}]
         
         total = len(self.problem["problem"]["testCases"])
         correct = 0
         output = ''
+        runtime = 0
         for test_case in self.problem["problem"]["testCases"]:
-            result = self.evaluate_robot_with_testcase(answer, test_case)
+            start = time.perf_counter()
+            result = self.evaluate_robot_with_testcase(answer, test_case, timeout_seconds)
+            runtime = max(runtime, time.perf_counter() - start)
             if result is not None and 'output' in result:
                 output += str(result["output"])
             if result is not None and 'success' in result and result["success"]:
                 correct += 1
             else:
                 break
-        return {"success": correct == total, "output": output}
+        return {"success": correct == total, "output": output, "runtime": runtime}
     
     def transform_code(self, code, data=None, problem_type=None):
         full_code = '''
@@ -88,7 +93,7 @@ async function prompt() {
 
         return full_code
 
-    def evaluate_robot_with_testcase(self, answer, testcase):
+    def evaluate_robot_with_testcase(self, answer, testcase, timeout_seconds=None):
         code = json.loads(answer)["code"]["javascript"]
         input_string = testcase.get('input', '') + '\n'
         
@@ -98,22 +103,11 @@ async function prompt() {
 
         full_code = self.transform_code(code, data)
 
-        tmpdirname = tempfile.mkdtemp() 
-        print(tmpdirname)
-        tmpfilename = os.path.join(tmpdirname, 'code.js')
-        with open(tmpfilename, 'w') as f:
-            f.write(full_code)
-        
         output = ''
         try:
-            env = os.environ.copy()
-            cwd = os.path.dirname(__file__)
-            env['NODE_PATH'] = os.path.join(cwd, 'node_modules') + ':' + env.get('NODE_PATH', '')
-            process = subprocess.Popen(['node', tmpfilename], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=env, cwd=cwd)
-
-            try:
-                output, _ = process.communicate(input=input_string.encode(), timeout=BlocompRunner.TIMEOUT_SECONDS)
+            output, timed_out = self.run_node(full_code, input_string, timeout_seconds)
 
+            if not timed_out:
                 if self.problem_type == 'cleaning':
                     json_string = output.decode().strip().split("\n")[-1]
                     try:
@@ -130,9 +124,6 @@ async function prompt() {
                     success = output.decode().strip() == testcase.get('output', '').strip()
                     print({"success": success, "output": output.decode()})
                     return {"success": success, "output": output.decode()}
-            except subprocess.TimeoutExpired:
-                process.kill()
-                output, _ = process.communicate()
             
         except Exception as e:
             print(traceback.format_exc())
@@ -142,24 +133,9 @@ async function prompt() {
     def evaluate_cleaning_robot_code(self, code):
         full_code = self.transform_code(code)
 
-        tmpdirname = tempfile.mkdtemp() 
-        print(tmpdirname)
-        tmpfilename = os.path.join(tmpdirname, 'code.js')
-        with open(tmpfilename, 'w') as f:
-            f.write(full_code)
-        
         output = ''
         try:
-            env = os.environ.copy()
-            cwd = os.path.dirname(__file__)
-            env['NODE_PATH'] = os.path.join(cwd, 'node_modules') + ':' + env.get('NODE_PATH', '')
-            process = subprocess.Popen(['node', tmpfilename], stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=env, cwd=cwd)
-
-            try:
-                output, _ = process.communicate(timeout=BlocompRunner.TIMEOUT_SECONDS)
-            except subprocess.TimeoutExpired:
-                process.kill()
-                output, _ = process.communicate()
+            output, _ = self.run_node(full_code)
 
             output = output.decode()
 
@@ -168,4 +144,38 @@ async function prompt() {
         except Exception as e:
             print(e)
             print(output)
-            return {"success": False, "output": str(e)}
\ No newline at end of file
+            return {"success": False, "output": str(e)}
+
+    def run_node(self, full_code, input_string=None, timeout_seconds=None):
+        '''
+        Runs `full_code` with node, feeding `input_string` to stdin.
+        Returns (output as bytes, whether the process timed out).
+        '''
+        if timeout_seconds is None:
+            timeout_seconds = BlocompRunner.TIMEOUT_SECONDS
+        result = recorder.sandbox('blocomp', {'code': full_code, 'input': input_string},
+                                  lambda: self._run_node(full_code, input_string, timeout_seconds), {'timeout': timeout_seconds})
+        return result['output'].encode('utf-8', 'surrogateescape'), result['timed_out']
+
+    def _run_node(self, full_code, input_string, timeout_seconds):
+        tmpdirname = tempfile.mkdtemp() 
+        print(tmpdirname)
+        tmpfilename = os.path.join(tmpdirname, 'code.js')
+        with open(tmpfilename, 'w') as f:
+            f.write(full_code)
+
+        env = os.environ.copy()
+        cwd = os.path.dirname(__file__)
+        env['NODE_PATH'] = os.path.join(cwd, 'node_modules') + ':' + env.get('NODE_PATH', '')
+        stdin = subprocess.PIPE if input_string is not None else None
+        process = subprocess.Popen(['node', tmpfilename], stdin=stdin, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=env, cwd=cwd)
+
+        timed_out = False
+        try:
+            output, _ = process.communicate(input=input_string.encode() if input_string is not None else None, timeout=timeout_seconds)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            output, _ = process.communicate()
+            timed_out = True
+
+        return {'exit_code': process.returncode, 'output': output.decode('utf-8', 'surrogateescape'), 'timed_out': timed_out}
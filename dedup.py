@@ -0,0 +1,153 @@
+import ast
+import symtable
+import json
+
+# programs that can observe their own identifiers are not renamed
+INTROSPECTION_NAMES = {'locals', 'globals', 'vars', 'dir', 'eval', 'exec', 'compile',
+                       'getattr', 'setattr', 'hasattr', 'delattr', '__import__'}
+INTROSPECTION_ATTRS = {'__name__', '__qualname__', '__dict__', '__code__', 'f_locals', 'f_globals',
+                       'modules', '_getframe'}
+# modules that reach the program's names by string (e.g., __main__.soma, doctest's >>> soma(1, 2))
+INTROSPECTION_MODULES = {'__main__', 'doctest', 'inspect'}
+
+class SpellingCollector(ast.NodeVisitor):
+    '''
+    Finds names whose spelling matters even where they are function locals
+    (classes, keyword argument names, imports without "as", match patterns), and
+    whether the program introspects its own names.
+    '''
+    def __init__(self):
+        self.fixed = set()
+        self.introspects = False
+
+    def visit_Name(self, node):
+        if node.id in INTROSPECTION_NAMES:
+            self.introspects = True
+
+    def visit_Attribute(self, node):
+        if node.attr in INTROSPECTION_ATTRS:
+            self.introspects = True
+        self.generic_visit(node)
+
+    def visit_ClassDef(self, node):
+        # class names show up in output (Enum members, dataclass reprs, type(obj))
+        self.fixed.add(node.name)
+        self.generic_visit(node)
+
+    def visit_keyword(self, node):
+        # keyword arguments are matched against parameter names
+        if node.arg is None:
+            self.introspects = True
+        else:
+            self.fixed.add(node.arg)
+        self.generic_visit(node)
+
+    def visit_alias(self, node):
+        if node.name.split('.')[0] in INTROSPECTION_MODULES:
+            self.introspects = True
+        if not node.asname:
+            self.fixed.add(node.name.split('.')[0])
+
+    def visit_ImportFrom(self, node):
+        if node.module and node.module.split('.')[0] in INTROSPECTION_MODULES:
+            self.introspects = True
+        self.generic_visit(node)
+
+    def generic_visit(self, node):
+        # match statements (Python 3.10+)
+        for field in ('name', 'rest'):
+            if type(node).__name__.startswith('Match') and isinstance(getattr(node, field, None), str):
+                self.fixed.add(getattr(node, field))
+        super().generic_visit(node)
+
+def function_locals(table):
+    '''
+    Returns (names that are local to some function, names used anywhere else).
+    Module-level names (functions, classes, globals), class members and
+    names a function reads as globals or builtins all count as "elsewhere":
+    test code and output can refer to them by name.
+    '''
+    local, elsewhere = set(), set()
+    is_function = table.get_type() == 'function'
+    for symbol in table.get_symbols():
+        if is_function and (symbol.is_local() or symbol.is_free()) and not symbol.is_global():
+            local.add(symbol.get_name())
+        else:
+            elsewhere.add(symbol.get_name())
+    for child in table.get_children():
+        child_local, child_elsewhere = function_locals(child)
+        local |= child_local
+        elsewhere |= child_elsewhere
+    return local, elsewhere
+
+class Renamer(ast.NodeTransformer):
+    '''
+    Renames the given identifiers to <v0>, <v1>, ... in order of first
+    appearance. The placeholders are not valid identifiers, so they never
+    collide with names the program uses without binding them.
+    '''
+    def __init__(self, names):
+        self.names = names
+        self.mapping = {}
+
+    def rename(self, name):
+        if name not in self.names:
+            return name
+        if name not in self.mapping:
+            self.mapping[name] = f'<v{len(self.mapping)}>'
+        return self.mapping[name]
+
+    def visit_Name(self, node):
+        node.id = self.rename(node.id)
+        return node
+
+    def visit_arg(self, node):
+        node.arg = self.rename(node.arg)
+        return self.generic_visit(node)
+
+    def visit_FunctionDef(self, node):
+        node.name = self.rename(node.name)
+        return self.generic_visit(node)
+
+    visit_AsyncFunctionDef = visit_FunctionDef
+
+    def visit_ExceptHandler(self, node):
+        if node.name:
+            node.name = self.rename(node.name)
+        return self.generic_visit(node)
+
+    def visit_alias(self, node):
+        if node.asname:
+            node.asname = self.rename(node.asname)
+        return node
+
+    def visit_Nonlocal(self, node):
+        node.names = [self.rename(name) for name in node.names]
+        return node
+
+def canonical_python(source):
+    '''
+    Canonical form of a Python program: its AST dump (so whitespace and
+    comments don't matter) with names that are only ever function locals
+    renamed to <v0>, <v1>, ... Module-level names, class members, builtins,
+    attributes and keyword argument names are kept.
+    Returns None if the source does not parse.
+    '''
+    try:
+        tree = ast.parse(source)
+        table = symtable.symtable(source, '<answer>', 'exec')
+    except (SyntaxError, ValueError):
+        return None
+    collector = SpellingCollector()
+    collector.visit(tree)
+    if not collector.introspects:
+        local, elsewhere = function_locals(table)
+        tree = Renamer(local - elsewhere - collector.fixed).visit(tree)
+    return ast.dump(tree)
+
+def canonical_blocomp(answer):
+    '''Canonical form of a Blocomp answer: the JavaScript generated from its blocks.'''
+    try:
+        return json.loads(answer)['code']['javascript']
+    except (ValueError, KeyError, TypeError):
+        return None
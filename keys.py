@@ -0,0 +1,6 @@
+import json
+import hashlib
+
+def make_key(*parts):
+    '''Stable hash of JSON-serializable parts, used to look up recorded runs and equivalent answers.'''
+    return hashlib.sha1(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()
@@ -5,13 +5,16 @@ import sys
 import requests
 import re
 import os
-import subprocess
 from collections import defaultdict
 from bs4 import BeautifulSoup
+from main2 import ScriptRunner
+from ratelimit import ControlledSession
 
 API_BASE_PATH = os.getenv('SUBMISSAO_API_BASE_PATH')
 USERNAME = os.getenv('SUBMISSAO_USERNAME')
 PASSWORD = os.getenv('SUBMISSAO_PASSWORD')
+# answers used to run without any time limit; keep it generous so slow but correct answers still pass
+TIMEOUT_SECONDS = int(os.getenv('SUBMISSAO_TIMEOUT_SECONDS', '60'))
 
 
 
@@ -19,9 +22,11 @@ class SubmissaoService:
     def __init__(self, api_base_path):
         self.api_base_path = api_base_path
         self.token = None
+        self.session = ControlledSession()
+        self.script_runner = None
 
     def login(self, username, password):
-        resp = requests.post(f'{self.api_base_path}/login.php', \
+        resp = self.session.post(f'{self.api_base_path}/login.php', \
             json = {
                 'username': username,
                 'password': password
@@ -33,7 +38,7 @@ class SubmissaoService:
             raise Exception("Erro ao fazer login")
 
     def get_assignments(self, pattern='%'):
-        r = requests.get(f'{self.api_base_path}/get-assignments.php', \
+        r = self.session.get(f'{self.api_base_path}/get-assignments.php', \
             params={'assignment_url': pattern})
         if (r.status_code == 200):
             return r.text.strip().split('\n')
@@ -42,27 +47,31 @@ class SubmissaoService:
 
     def evaluate_all(self, update=False, overwrite=False):
         ret = {}
+        if self.script_runner is None:
+            self.script_runner = ScriptRunner(timeout_seconds=TIMEOUT_SECONDS)
         for assignment in self.get_assignments():
-            ass = AssignmentService(assignment, self.api_base_path, self.token)
+            ass = AssignmentService(assignment, self.api_base_path, self.token, self.session, self.script_runner)
             try:
                 ret.update(ass.evaluate_all(update, overwrite))
             except Exception as e:
                 print(e)
-            time.sleep(2)
         return ret
 
 class AssignmentService:
-    def __init__(self, assignment_url, api_base_path, token):
+    def __init__(self, assignment_url, api_base_path, token, session=None, script_runner=None):
         self.assignment_url = assignment_url
         self.api_base_path = api_base_path
         self.token = token
+        self.session = session if session is not None else ControlledSession()
+        self.script_runner = script_runner
         self.codes = None
         self.answers = None
+        self.stats = None
 
     def get_code_in_textareas(self):
         if self.codes is None:
             print('get_code_in_textareas ', self.assignment_url)
-            r = requests.get(self.assignment_url)
+            r = self.session.get(self.assignment_url)
             soup = BeautifulSoup(r.content, 'html5lib')
             ret = []
             for textarea in soup.find_all('textarea', 'code'):
@@ -90,8 +99,10 @@ class AssignmentService:
     def _get_stats(self):
         if '0.0.0.0' in self.assignment_url:
             return ''
+        if self.stats is not None:
+            return self.stats
         print('_get_stats ', self.assignment_url)
-        resp = requests.get(f'{self.api_base_path}/assignment-stats.php', \
+        resp = self.session.get(f'{self.api_base_path}/assignment-stats.php', \
             params = {
                 'url': self.assignment_url,
                 'submission_type': 'batch'
@@ -106,7 +117,8 @@ class AssignmentService:
         #     },)
         print('_get_stats ok')
         if (resp.status_code == 200):
-            return resp.text
+            self.stats = resp.text
+            return self.stats
         else:
             raise Exception("Erro ao consultar estatísticas")
 
@@ -122,7 +134,7 @@ class AssignmentService:
     def get_answers(self, username):
         print('get_answers ', self.assignment_url)
         if self.answers is None:
-            r = requests.post(f'{self.api_base_path}/get-answers.php', \
+            r = self.session.post(f'{self.api_base_path}/get-answers.php', \
                 headers = {
                     'Authorization': 'Bearer ' + self.token
                 },
@@ -146,7 +158,7 @@ class AssignmentService:
                     'submission_type': 'batch'
                 }
             print('get_all_answers ', self.assignment_url)
-            r = requests.post(f'{self.api_base_path}/get-answers2.php', \
+            r = self.session.post(f'{self.api_base_path}/get-answers2.php', \
                 headers = {
                     'Authorization': 'Bearer ' + self.token
                 },
@@ -181,15 +193,14 @@ class AssignmentService:
         # answer = self.get_answers(username)[question_index]
         # answer += '\n' + self.get_tests(question_index)
         answer = self.answer_with_tests(answer, question_index)
-        cmd = ['docker', 'run', '-i', '--rm', 'python:3.10-alpine', '/bin/sh', '-c', 'python', '-']
-        proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-        output, errors = proc.communicate(input=answer)
-        proc.wait()
-        return proc.returncode == 0
+        if self.script_runner is None:
+            self.script_runner = ScriptRunner(timeout_seconds=TIMEOUT_SECONDS)
+        exit_code, output = self.script_runner.run(answer)
+        return exit_code == 0
 
     def update_score(self, id, score):
         print('update_score ', self.assignment_url)
-        r = requests.post(f'{self.api_base_path}/update-score.php', \
+        r = self.session.post(f'{self.api_base_path}/update-score.php', \
             headers = {
                 'Authorization': 'Bearer ' + self.token
             },
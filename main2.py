@@ -1,18 +1,23 @@
 import requests # type: ignore
 import os
 import re
-import io
-import docker
+import math
+import time
 from datetime import datetime
-from bs4 import BeautifulSoup # type: ignore
 import tempfile
 import subprocess
 import json
 import subprocess
 import traceback
-from blocomp import BlocompRunner
+from concurrent.futures import ThreadPoolExecutor
+from recorder import recorder
+from ratelimit import ControlledSession, MAX_CONCURRENCY
+from dedup import canonical_python, canonical_blocomp
+from keys import make_key
 
 SUBMISSION_BATCH_SIZE = 5
+# score output of an answer graded through an equivalent one, whose raw output may show someone else's code
+EQUIVALENT_ANSWER_OUTPUT = 'Same result as an equivalent answer (output not shown).'
 API_BASE_PATH = os.getenv('SUBMISSAO_API_BASE_PATH')
 USERNAME = os.getenv('SUBMISSAO_USERNAME')
 PASSWORD = os.getenv('SUBMISSAO_PASSWORD')
@@ -21,13 +26,26 @@ FLUTTER_PROJECT_PATH = os.getenv('FLUTTER_PROJECT_PATH', '~/local/git/aulas/_inc
 # comma-separated list of ids
 CLASSROOM_ID = os.getenv('CLASSROOM_ID')
 RETEST_WRONG = os.getenv('RETEST_WRONG', 'False') in ('True', 'true')
-
-class EzSession(requests.Session):
+# per-question timeouts learned from the runtimes of passing submissions
+TIMEOUTS_CACHE_PATH = os.getenv('TIMEOUTS_CACHE_PATH', 'timeouts.json')
+# re-run submissions that already passed (without updating scores) to collect runtimes
+CALIBRATE_TIMEOUTS = os.getenv('CALIBRATE_TIMEOUTS', 'False') in ('True', 'true')
+# timeout = TIMEOUT_FACTOR * p95 of the runtimes, once there are MIN_RUNTIME_SAMPLES of them
+TIMEOUT_FACTOR = 3
+MIN_RUNTIME_SAMPLES = 5
+MAX_RUNTIME_SAMPLES = 100
+MIN_TIMEOUT_SECONDS = 0.5
+MAX_TIMEOUT_SECONDS = 60
+
+class EzSession(ControlledSession):
     def __init__(self, base_url):
         super().__init__()
         self.base_url = base_url
     
     def request(self, method, url, **kwargs):
+        return recorder.http(self._send, method, url, **kwargs)
+
+    def _send(self, method, url, **kwargs):
         if (url.startswith('http')):
             return super().request(method, url, **kwargs)
         else:
@@ -69,6 +87,12 @@ class EzAPI:
 class ScriptRunner:
     def __init__(self, reuse_container=True, timeout_seconds=3):
         self.timeout_seconds = timeout_seconds
+        self.container = None
+        if recorder.replaying_sandbox:
+            # recorded results are used, so there is no need for Docker
+            return
+        # imported here so that runs without Python answers don't pay for it
+        import docker
         container_name = 'ezsubmission-python'
         client = docker.from_env()
 
@@ -117,7 +141,14 @@ class ScriptRunner:
         self.container.stop()
         self.container.remove(force=True)
 
-    def run(self, code, input=''):
+    def run(self, code, input='', timeout_seconds=None):
+        if timeout_seconds is None:
+            timeout_seconds = self.timeout_seconds
+        result = recorder.sandbox('python', {'code': code, 'input': input},
+                                  lambda: self._run(code, input, timeout_seconds), {'timeout': timeout_seconds})
+        return (result['exit_code'], result['output'])
+
+    def _run(self, code, input, timeout_seconds):
         if not os.path.exists('app'):
             os.makedirs('app')
         with open('app/tupy.py', 'w') as f:
@@ -127,29 +158,33 @@ class ScriptRunner:
         with open('app/input.txt', 'w') as f:
             f.write(input)
 
-        output = io.StringIO()
-        res = self.container.exec_run(f'/bin/sh -c "cat /app/input.txt | timeout {self.timeout_seconds}s python /app/script.py"', stream=True, demux=False)
-        for line in res.output:
-            output.write(line.decode('utf-8'))
+        # not streamed, so that the exit code is available
+        res = self.container.exec_run(f'/bin/sh -c "cat /app/input.txt | timeout {timeout_seconds:g}s python /app/script.py"', demux=False)
         
-        return (res.exit_code, output.getvalue())
+        return {'exit_code': res.exit_code, 'output': res.output.decode('utf-8')}
 
 class PythonTestRunner:
     def __init__(self, script_runner):
         self.script_runner = script_runner
 
-    def evaluate_with_testcode(self, answer, tests, extras):
+    @staticmethod
+    def build_test_source(answer, tests):
         if '[[[code]]]' not in tests:
             tests = '[[[header]]]\n[[[code]]]\n[[[footer]]]' + tests;
         
-        full_source = tests \
+        return tests \
           .replace('[[[header]]]', '__print = print; print = lambda *args, **kwargs: None; __input = input; input = lambda *args, **kwargs: "3";') \
           .replace('[[[footer]]]', '\nprint = __print; input = __input\n') \
           .replace('[[[code]]]',  answer);
 
-        exit_code, output = self.script_runner.run(full_source)
+    def evaluate_with_testcode(self, answer, tests, extras):
+        full_source = PythonTestRunner.build_test_source(answer, tests)
+
+        start = time.perf_counter()
+        exit_code, output = self.script_runner.run(full_source, timeout_seconds=extras.get('timeout'))
+        runtime = time.perf_counter() - start
         success = output.strip() == '' or re.match('^[.]+$', output.split('\n')[0])
-        return {"success": success, "output": output}
+        return {"success": success, "output": output, "runtime": runtime}
 
     def evaluate_with_testcases(self, answer, tests, extras):
         def transform(s):
@@ -158,17 +193,22 @@ class PythonTestRunner:
         cases = [c.split(']]]') for c in tests.strip().split('=====') if c.strip() != '']        
         cases = [(transform(c[0]), transform(c[1])) for c in cases]
         success_count = 0
+        runtime = 0
         for test_in, test_out in cases:
-            exit_code, output = self.script_runner.run(answer, test_in)
+            start = time.perf_counter()
+            exit_code, output = self.script_runner.run(answer, test_in, timeout_seconds=extras.get('timeout'))
+            runtime = max(runtime, time.perf_counter() - start)
             if output.strip() == test_out.strip():
                 success_count += 1
         success = success_count == len(cases)
         output = f'{success_count}/{len(cases)}'
-        return {"success": success, "output": output}
+        return {"success": success, "output": output, "runtime": runtime}
 
 
 # TODO: run in a container
 class FlutterRunner:
+    TIMEOUT_SECONDS = 20
+
     def evaluate_with_testcode(self, answer, tests, extras):
         if 'filename' not in extras:
             raise Exception('Filename not specified using the data-filename HTML attribute.')
@@ -192,27 +232,114 @@ class FlutterRunner:
             # Run dart/flutter test
             dart_or_flutter_cmd = 'flutter' if extras['lang'] == 'flutter' else 'dart'
             print(f'Dart or flutter: {dart_or_flutter_cmd}')
+            timeout_seconds = extras.get('timeout', FlutterRunner.TIMEOUT_SECONDS)
+            start = time.perf_counter()
             try:
-                output = subprocess.check_output(f'cd {tmpdirname}/{project_dir} && timeout 20s {dart_or_flutter_cmd} test test/{test_script_name}', shell=True, stderr=subprocess.STDOUT).decode()
+                output = subprocess.check_output(f'cd {tmpdirname}/{project_dir} && timeout {timeout_seconds:g}s {dart_or_flutter_cmd} test test/{test_script_name}', shell=True, stderr=subprocess.STDOUT).decode()
             except subprocess.CalledProcessError as e:
                 output = e.output.decode()
+            runtime = time.perf_counter() - start
 
             #exit_code, output = self.script_runner.run(f'cd {tmpdirname} && flutter test')
         
             # success should be true if output contains 'All tests passed!'
             success = 'All tests passed!' in output
-            return {"output": output, "success": success}
+            return {"output": output, "success": success, "runtime": runtime}
 
 
-class AssignmentService:
+class Runners:
+    '''Creates runners on first use, so a run only pays for the languages it actually grades.'''
     def __init__(self):
+        self.script_runner = None
+        self.blocomp_runners = {}
+
+    def get_runner(self, assignment_url, extras):
+        if 'lang' in extras and extras['lang'] in ('flutter', 'dart'):
+            return FlutterRunner()
+        elif 'lang' in extras and extras['lang'] == 'blocomp':
+            if assignment_url not in self.blocomp_runners:
+                from blocomp import BlocompRunner
+                self.blocomp_runners[assignment_url] = BlocompRunner(assignment_url)
+            return self.blocomp_runners[assignment_url]
+        else:
+            if self.script_runner is None:
+                self.script_runner = ScriptRunner()
+            return PythonTestRunner(self.script_runner)
+
+
+class AssignmentService:
+    def __init__(self, timeouts_cache_path=TIMEOUTS_CACHE_PATH):
         self.assignments = {}
+        self.timeouts_cache_path = timeouts_cache_path
+        # recorded and replayed runs must see the same timeouts, and a replay must not touch the production cache
+        self.frozen = recorder.recording or recorder.replaying
+        self.runtimes = self.load_runtimes()
     
     def get_assignment(self, assignment_url):
         if (assignment_url not in self.assignments):
-            self.assignments[assignment_url] = Assignment(assignment_url)
+            runtimes = self.runtimes.setdefault(assignment_url, {})
+            self.assignments[assignment_url] = Assignment(assignment_url, runtimes)
         return self.assignments[assignment_url]
 
+    def load_runtimes(self):
+        '''
+        Returns {assignment_url: {question_index: {'extras_hash': ..., 'runtimes': [...]}}},
+        with the runtimes of passing submissions and the hash of the question they ran against.
+        '''
+        if self.timeouts_cache_path is None or not os.path.exists(self.timeouts_cache_path):
+            return {}
+        with open(self.timeouts_cache_path, 'r') as f:
+            cache = json.load(f)
+        return {url: {int(index): {'extras_hash': question.get('extras_hash'), 'runtimes': question['runtimes']}
+                      for index, question in questions.items()}
+                for url, questions in cache.items()}
+
+    def save_runtimes(self):
+        if self.timeouts_cache_path is None or self.frozen or not self.assignments:
+            return
+        cache = {}
+        for url, questions in self.runtimes.items():
+            if questions:
+                cache[url] = {str(index): {'extras_hash': question['extras_hash'],
+                                           'timeout': calibrated_timeout(question['runtimes']),
+                                           'runtimes': question['runtimes']}
+                              for index, question in questions.items()}
+        with open(self.timeouts_cache_path, 'w') as f:
+            json.dump(cache, f, indent=2)
+
+def question_hash(extras):
+    '''Hash of what determines a question's runtime, so learned runtimes are dropped when its tests change.'''
+    return make_key({k: extras[k] for k in ('lang', 'filename', 'testcode', 'testcases', 'runtemplate') if k in extras})
+
+def calibrated_timeout(runtimes):
+    '''Timeout for a question given the runtimes of its passing submissions, or None if there are too few.'''
+    if len(runtimes) < MIN_RUNTIME_SAMPLES:
+        return None
+    ordered = sorted(runtimes)
+    p95 = ordered[min(len(ordered) - 1, math.ceil(0.95 * len(ordered)) - 1)]
+    timeout = min(MAX_TIMEOUT_SECONDS, max(MIN_TIMEOUT_SECONDS, TIMEOUT_FACTOR * p95))
+    return round(timeout, 1)
+
+def dedup_key(assignment_url, extras, answer):
+    '''
+    Submissions with the same key get the same test results. Python answers
+    are compared by the canonical form of the program that is actually run
+    (test code included, since it refers to names in the answer); Blocomp
+    answers by their generated JavaScript; other languages by their text.
+    '''
+    lang = extras.get('lang')
+    canonical = None
+    if lang == 'blocomp':
+        canonical = canonical_blocomp(answer)
+    elif lang not in ('flutter', 'dart'):
+        if 'testcode' in extras:
+            canonical = canonical_python(PythonTestRunner.build_test_source(answer, extras['testcode']['contents']))
+        else:
+            canonical = canonical_python(answer)
+    if canonical is None:
+        canonical = answer
+    return make_key(assignment_url, extras, lang, canonical)
+
 def remove_elements_starting_from_element(lst, elem):
     index_of_elem = lst.index(elem) if elem in lst else -1
     if index_of_elem != -1:
@@ -231,14 +358,17 @@ def next_until(soup, from_elem, until_selector):
     return ret
 
 class Assignment:
-    def __init__(self, assignment_url):
+    def __init__(self, assignment_url, runtimes=None):
         self.assignment_url = assignment_url
+        self.runtimes = runtimes if runtimes is not None else {}
         self.load_extras()
+        self.discard_stale_runtimes()
 
     def load_extras(self):
         extras = []
 
-        r = requests.get(self.assignment_url)
+        r = recorder.http(requests.request, 'GET', self.assignment_url)
+        from bs4 import BeautifulSoup # type: ignore
         soup = BeautifulSoup(r.content, 'html5lib')
         
         for code_elem in soup.select('.code'):
@@ -264,48 +394,87 @@ class Assignment:
         
         self.extras = extras
 
-    def get_extras_for_question(self, question_index):
-        return self.extras[question_index]
+    def discard_stale_runtimes(self):
+        for question_index, question in list(self.runtimes.items()):
+            if question_index >= len(self.extras) or question['extras_hash'] != question_hash(self.extras[question_index]):
+                print(f'Question {question_index} of {self.assignment_url} changed, discarding learned runtimes')
+                del self.runtimes[question_index]
+
+    def get_extras_for_question(self, question_index, with_timeout=True):
+        extras = self.extras[question_index]
+        timeout = calibrated_timeout(self.runtimes.get(question_index, {}).get('runtimes', []))
+        if with_timeout and timeout is not None:
+            extras = dict(extras, timeout=timeout)
+        return extras
+
+    def add_runtime(self, question_index, runtime):
+        question = self.runtimes.setdefault(question_index, {
+            'extras_hash': question_hash(self.extras[question_index]),
+            'runtimes': []})
+        runtimes = question['runtimes']
+        runtimes.append(round(runtime, 3))
+        del runtimes[:-MAX_RUNTIME_SAMPLES]
 
 def main():
     service = AssignmentService()
-    python_script_runner = ScriptRunner()
+    runners = Runners()
     api = EzAPI(API_BASE_PATH)
     now = datetime.now().strftime('%Y-%m-%d %H:%M:%S %z')
 
     api.login(USERNAME, PASSWORD)
-    for classroom_id in CLASSROOM_ID.split(','):
+    # classrooms are fetched and scores uploaded concurrently; the session's
+    # controller decides how many requests are actually in flight
+    executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENCY)
+    uploads = []
+    classroom_ids = CLASSROOM_ID.split(',')
+    classrooms = executor.map(api.get_assignments_with_answers, classroom_ids)
+    for classroom_id, assignments in zip(classroom_ids, classrooms):
         print(f'Evaluating classroom {classroom_id}...')
         submissions_to_update = []
-        assignments = api.get_assignments_with_answers(classroom_id)
+        # (answer, test results) by dedup_key, so that equivalent answers are run only once
+        results_cache = {}
         for assignment in assignments:
             for submission in assignment['submissions']:
-                if (submission['score'] is None) or (RETEST_WRONG and (submission['score'] < '1.000' or submission['score'] == '0.000')):
+                # submissions that already passed are only run to calibrate the timeouts
+                calibrating = CALIBRATE_TIMEOUTS and submission['score'] == '1.000'
+                if (submission['score'] is None) or (RETEST_WRONG and (submission['score'] < '1.000' or submission['score'] == '0.000')) or calibrating:
                     print('Evaluating submission', submission['id'], 'with question index', submission['question_index'], '... ', end='')
                     answer = submission['answer']
-                    extras = service.get_assignment(assignment['assignment_url']).get_extras_for_question(submission['question_index'])
+                    assignment_obj = service.get_assignment(assignment['assignment_url'])
+                    extras = assignment_obj.get_extras_for_question(submission['question_index'], with_timeout=not calibrating)
                     test_results = None
                     # use runtemplate if available
                     # if 'runtemplate' in extras:
                     #     answer = extras['runtemplate']['contents'].replace('[[[code]]]', answer);
 
-                    if 'lang' in extras and extras['lang'] in ('flutter', 'dart'):
-                        runner = FlutterRunner()
-                    elif 'lang' in extras and extras['lang'] == 'blocomp':
-                        runner = BlocompRunner(assignment['assignment_url'])
+                    key = dedup_key(assignment['assignment_url'], extras, answer)
+                    cached_answer, cached_results = results_cache.get(key, (None, None))
+                    # a failing answer is only reused verbatim, so it keeps its own error output
+                    if cached_results is not None and (cached_results['success'] or cached_answer == answer):
+                        print('(same as a previous answer) ', end='')
+                        test_results = cached_results
+                        # testcases output is just the number of passed cases
+                        if cached_answer != answer and 'testcases' not in extras:
+                            test_results = {'success': True, 'output': EQUIVALENT_ANSWER_OUTPUT}
                     else:
-                        runner = PythonTestRunner(python_script_runner)
-                    
+                        runner = runners.get_runner(assignment['assignment_url'], extras)
+
+                        if 'testcases' in extras:
+                            test_results = runner.evaluate_with_testcases(answer, extras['testcases']['contents'], extras)
+                        elif 'testcode' in extras:
+                            test_results = runner.evaluate_with_testcode(answer, extras['testcode']['contents'], extras)
+                        else:
+                            test_results = runner.evaluate(answer, extras.get('timeout'))
+                        results_cache[key] = (answer, test_results)
+                        if test_results['success'] and 'runtime' in test_results and not service.frozen:
+                            assignment_obj.add_runtime(submission['question_index'], test_results['runtime'])
+
                     score = 0
-                    if 'testcases' in extras:
-                        test_results = runner.evaluate_with_testcases(answer, extras['testcases']['contents'], extras)
-                    elif 'testcode' in extras:
-                        test_results = runner.evaluate_with_testcode(answer, extras['testcode']['contents'], extras)
-                    else:
-                        test_results = runner.evaluate(answer)
                     if test_results['success']:
                         score = 1
                     print('score:', score)
+                    if calibrating:
+                        continue
                     submissions_to_update.append({
                         'id': submission['id'],
                         'score': score,
@@ -313,10 +482,16 @@ def main():
                         'score_output': test_results['output']})
                     if len(submissions_to_update) >= SUBMISSION_BATCH_SIZE:
                         print('Updating score...')
-                        api.update_score(submissions_to_update)
+                        uploads.append(executor.submit(api.update_score, submissions_to_update))
                         submissions_to_update = []
     
-        api.update_score(submissions_to_update)
+        if submissions_to_update:
+            uploads.append(executor.submit(api.update_score, submissions_to_update))
+    for upload in uploads:
+        # re-raises upload errors
+        upload.result()
+    executor.shutdown()
+    service.save_runtimes()
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
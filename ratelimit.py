@@ -0,0 +1,229 @@
+import os
+import re
+import time
+import threading
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+from urllib.parse import urlparse
+from collections import deque
+import requests # type: ignore
+
+# upper bound for the number of requests in flight at the same time
+MAX_CONCURRENCY = int(os.getenv('SUBMISSAO_MAX_CONCURRENCY', '8'))
+# upper bound for the per-endpoint rate once the server has pushed back;
+# endpoints are not throttled at all until then
+MAX_REQUESTS_PER_SECOND = float(os.getenv('SUBMISSAO_MAX_REQUESTS_PER_SECOND', '50'))
+# number of times a request is retried after 429/503 responses
+MAX_RETRIES = int(os.getenv('SUBMISSAO_MAX_RETRIES', '3'))
+
+INITIAL_CONCURRENCY = 4
+MIN_REQUESTS_PER_SECOND = 0.2
+# a response slower than LATENCY_FACTOR times the fastest one seen for the
+# same endpoint and response size is a sign of congestion...
+LATENCY_FACTOR = 3
+# ...unless it is faster than this (seconds), to ignore noise on fast endpoints
+MIN_CONGESTED_LATENCY = 0.2
+MAX_RETRY_AFTER = 300
+
+class TokenBucket:
+    '''Token bucket; a rate of None means unlimited.'''
+    def __init__(self, rate=None, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self.blocked_until = 0
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        if self.rate is None:
+            self.tokens = self.capacity
+        else:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def acquire(self):
+        '''Blocks until a token is available and consumes it.'''
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self._refill(now)
+                if now >= self.blocked_until and self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = self.blocked_until - now
+                if self.rate is not None:
+                    wait = max(wait, (1 - self.tokens) / self.rate)
+            time.sleep(wait)
+
+    def block(self, seconds):
+        '''Hands out no tokens for the next `seconds` seconds (e.g., Retry-After).'''
+        with self.lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+            self.tokens = 0
+
+class Endpoint:
+    def __init__(self):
+        self.bucket = TokenBucket()
+        self.last_decrease = 0
+        # send times of the last second, to know the rate when the server first pushes back
+        self.recent = deque()
+        # fastest latency seen, by response size class
+        self.min_latency = {}
+
+    def sent(self, now):
+        self.recent.append(now)
+        while self.recent and self.recent[0] < now - 1:
+            self.recent.popleft()
+
+def size_class(resp):
+    '''Responses within a factor of 4 in size are compared with each other.'''
+    return max(len(resp.content), 1).bit_length() // 2
+
+class AdaptiveController:
+    '''
+    Client-side flow control for the submission API.
+
+    All endpoints share an AIMD concurrency window: it grows by about one
+    request per window of fast successful responses and is halved on
+    429/5xx responses, connection errors or latency well above the best
+    seen for the same endpoint and response size (so a large classroom is
+    not mistaken for congestion).
+
+    Endpoints are not rate limited until the server pushes back with a
+    429/5xx; from then on each has a token bucket, halved on every error
+    and grown additively on success until it is unlimited again.
+    Retry-After is honored and 429/503 responses are retried.
+    '''
+    def __init__(self, max_concurrency=MAX_CONCURRENCY, max_rate=MAX_REQUESTS_PER_SECOND,
+                 max_retries=MAX_RETRIES):
+        self.max_concurrency = max_concurrency
+        self.max_rate = max_rate
+        self.max_retries = max_retries
+        self.concurrency = float(min(INITIAL_CONCURRENCY, max_concurrency))
+        self.in_flight = 0
+        self.last_window_decrease = 0
+        self.endpoints = {}
+        self.condition = threading.Condition()
+
+    def endpoint_key(self, method, url):
+        parsed = urlparse(url)
+        path = re.sub(r'/\d+(?=/|$)', '/{id}', parsed.path)
+        return f'{method.upper()} {parsed.netloc}{path}'
+
+    def get_endpoint(self, key):
+        with self.condition:
+            if key not in self.endpoints:
+                self.endpoints[key] = Endpoint()
+            return self.endpoints[key]
+
+    def _acquire_slot(self, endpoint):
+        with self.condition:
+            while self.in_flight >= int(self.concurrency):
+                self.condition.wait()
+            self.in_flight += 1
+            endpoint.sent(time.monotonic())
+
+    def _release_slot(self):
+        with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+    def _grow_window(self):
+        with self.condition:
+            self.concurrency = min(self.max_concurrency, self.concurrency + 1 / self.concurrency)
+            self.condition.notify_all()
+
+    def _shrink_window(self, latency):
+        with self.condition:
+            now = time.monotonic()
+            # one decrease per round trip, so a burst of signals doesn't collapse the window
+            if now - self.last_window_decrease < latency:
+                return
+            self.last_window_decrease = now
+            self.concurrency = max(1.0, self.concurrency / 2)
+
+    def _increase_rate(self, endpoint):
+        with self.condition:
+            bucket = endpoint.bucket
+            if bucket.rate is not None:
+                bucket.rate += 1 / bucket.rate
+                if bucket.rate >= self.max_rate:
+                    bucket.rate = None
+
+    def _decrease_rate(self, endpoint):
+        with self.condition:
+            now = time.monotonic()
+            bucket = endpoint.bucket
+            current = bucket.rate if bucket.rate is not None else min(self.max_rate, len(endpoint.recent))
+            if bucket.rate is not None and now - endpoint.last_decrease < 1 / bucket.rate:
+                return
+            endpoint.last_decrease = now
+            bucket.rate = max(MIN_REQUESTS_PER_SECOND, current / 2)
+
+    def observe(self, endpoint, resp, latency):
+        if resp is None or resp.status_code == 429 or resp.status_code >= 500:
+            self._decrease_rate(endpoint)
+            self._shrink_window(latency)
+            return
+        self._increase_rate(endpoint)
+        size = size_class(resp)
+        best = endpoint.min_latency.get(size)
+        if best is None or latency < best:
+            endpoint.min_latency[size] = best = latency
+        if latency > max(MIN_CONGESTED_LATENCY, LATENCY_FACTOR * best):
+            self._shrink_window(latency)
+        else:
+            self._grow_window()
+
+    def retry_after(self, resp, attempt):
+        '''Seconds to wait before retrying, or None if `resp` should not be retried.'''
+        value = resp.headers.get('Retry-After')
+        seconds = None
+        if value is not None:
+            try:
+                seconds = float(value)
+            except ValueError:
+                try:
+                    seconds = (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds()
+                except (TypeError, ValueError):
+                    pass
+        if resp.status_code == 429 and seconds is None:
+            seconds = 2 ** attempt
+        if resp.status_code not in (429, 503) or seconds is None:
+            return None
+        return min(MAX_RETRY_AFTER, max(0, seconds))
+
+    def send(self, send, method, url, **kwargs):
+        '''Sends a request with `send`, respecting the limits of its endpoint.'''
+        endpoint = self.get_endpoint(self.endpoint_key(method, url))
+        attempt = 0
+        while True:
+            endpoint.bucket.acquire()
+            self._acquire_slot(endpoint)
+            resp = None
+            start = time.monotonic()
+            try:
+                resp = send(method, url, **kwargs)
+            finally:
+                self._release_slot()
+                self.observe(endpoint, resp, time.monotonic() - start)
+
+            wait = self.retry_after(resp, attempt)
+            if wait is None or attempt >= self.max_retries:
+                return resp
+            print(f'{resp.status_code} from {url}, retrying in {wait:.1f}s')
+            endpoint.bucket.block(wait)
+            attempt += 1
+
+class ControlledSession(requests.Session):
+    '''requests.Session whose requests go through an AdaptiveController.'''
+    def __init__(self, controller=None):
+        super().__init__()
+        self.controller = controller if controller is not None else default_controller
+
+    def request(self, method, url, **kwargs):
+        return self.controller.send(super().request, method, url, **kwargs)
+
+# shared by every client in the process
+default_controller = AdaptiveController()
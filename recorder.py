@@ -0,0 +1,180 @@
+import os
+import json
+import gzip
+import time
+import atexit
+import threading
+from collections import defaultdict, deque
+import requests # type: ignore
+from keys import make_key
+
+# Path of a .jsonl.gz archive where HTTP exchanges and sandbox runs are recorded
+RECORD_ARCHIVE = os.getenv('RECORD_ARCHIVE')
+# Path of a previously recorded archive to replay (no network, no credentials)
+REPLAY_ARCHIVE = os.getenv('REPLAY_ARCHIVE')
+# When replaying, also reuse recorded sandbox results instead of executing the code again
+REPLAY_SANDBOX = os.getenv('REPLAY_SANDBOX', 'False') in ('True', 'true')
+
+REDACTED = '*****'
+SENSITIVE_KEYS = ('password', 'access_token', 'token')
+
+def redact(value):
+    if isinstance(value, dict):
+        return {k: REDACTED if k in SENSITIVE_KEYS else redact(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [redact(v) for v in value]
+    return value
+
+class RecordedResponse:
+    '''Minimal stand-in for requests.Response built from an archive entry.'''
+    def __init__(self, url, status_code, text, headers):
+        self.url = url
+        self.status_code = status_code
+        self.text = text
+        self.content = text.encode('utf-8', 'surrogateescape')
+        self.headers = requests.structures.CaseInsensitiveDict(headers)
+
+    def json(self):
+        return json.loads(self.text)
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError(f'{self.status_code} Error for url: {self.url}', response=self)
+
+    def __repr__(self):
+        return f'<RecordedResponse [{self.status_code}]>'
+
+class Recorder:
+    '''
+    Records HTTP exchanges and sandbox invocations into a compact archive
+    (gzipped JSON lines) or replays them from one.
+
+    Entries are looked up by method and URL (HTTP) or by a hash of the
+    executed code and input (sandbox). Repeated lookups of the same key are
+    answered in the order they were recorded; the last entry is reused when
+    the replay asks for more than was recorded.
+    '''
+    def __init__(self, record_path=None, replay_path=None, replay_sandbox=False):
+        if record_path and replay_path:
+            raise Exception('Cannot record and replay at the same time')
+        self.record_path = record_path
+        self.replay_path = replay_path
+        self.replay_sandbox = replay_sandbox
+        self.archive = None
+        self.lock = threading.Lock()
+        self.entries = defaultdict(deque)
+        if replay_path:
+            self.load(replay_path)
+
+    @classmethod
+    def from_env(cls):
+        return cls(RECORD_ARCHIVE, REPLAY_ARCHIVE, REPLAY_SANDBOX)
+
+    @property
+    def recording(self):
+        return self.record_path is not None
+
+    @property
+    def replaying(self):
+        return self.replay_path is not None
+
+    @property
+    def replaying_sandbox(self):
+        return self.replaying and self.replay_sandbox
+
+    def load(self, path):
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            for line in f:
+                entry = json.loads(line)
+                self.entries[entry['key']].append(entry)
+        print(f'Replaying {sum(len(q) for q in self.entries.values())} entries from {path}')
+
+    def write(self, entry):
+        # requests may be sent from several threads
+        with self.lock:
+            if self.archive is None:
+                self.archive = gzip.open(self.record_path, 'wt', encoding='utf-8')
+                atexit.register(self.close)
+            self.archive.write(json.dumps(entry) + '\n')
+
+    def close(self):
+        if self.archive is not None:
+            self.archive.close()
+            self.archive = None
+
+    def lookup(self, key, description):
+        with self.lock:
+            queue = self.entries.get(key)
+            if not queue:
+                raise Exception(f'No recorded entry for {description}')
+            return queue.popleft() if len(queue) > 1 else queue[0]
+
+    def http(self, send, method, url, **kwargs):
+        '''Performs (or replays) an HTTP request; `send` does the real request.'''
+        if not (self.recording or self.replaying):
+            return send(method, url, **kwargs)
+
+        key = make_key('http', method.upper(), url, kwargs.get('params'))
+        if self.replaying:
+            entry = self.lookup(key, f'{method.upper()} {url}')
+            return RecordedResponse(url, entry['status_code'], entry['response'], entry['headers'])
+
+        start = time.perf_counter()
+        resp = send(method, url, **kwargs)
+        duration = time.perf_counter() - start
+        text = resp.content.decode('utf-8', 'surrogateescape')
+        try:
+            text = json.dumps(redact(json.loads(text)))
+        except ValueError:
+            pass
+        self.write({
+            'key': key,
+            'type': 'http',
+            'method': method.upper(),
+            'url': url,
+            'params': kwargs.get('params'),
+            'request': redact(kwargs.get('json', kwargs.get('data'))),
+            'status_code': resp.status_code,
+            'headers': {k: v for k, v in resp.headers.items() if k.lower() in ('content-type', 'retry-after')},
+            'response': text,
+            'duration': duration})
+        return resp
+
+    def sandbox(self, kind, payload, run, settings=None):
+        '''
+        Executes (or replays) a sandbox invocation. `run` must return a
+        JSON-serializable dict with at least `exit_code` and `output`.
+        `settings` (e.g., the timeout) are stored with the entry but are not
+        part of its key, so a replay still matches when they changed.
+        '''
+        if not (self.recording or self.replaying):
+            return run()
+
+        key = make_key('sandbox', kind, payload)
+        if self.replaying_sandbox:
+            entry = self.lookup(key, f'{kind} sandbox run')
+            return entry['result']
+
+        start = time.perf_counter()
+        result = run()
+        duration = time.perf_counter() - start
+        if self.recording:
+            self.write({
+                'key': key,
+                'type': 'sandbox',
+                'kind': kind,
+                'input': payload,
+                'settings': settings,
+                'result': result,
+                'duration': duration})
+        elif self.replaying:
+            queue = self.entries.get(key)
+            if not queue:
+                print(f'[replay] {kind} run not in archive ({duration:.3f}s)')
+            else:
+                expected = queue.popleft() if len(queue) > 1 else queue[0]
+                status = 'same' if expected['result'] == result else 'DIFFERENT'
+                print(f'[replay] {kind} run: {status} result, {duration:.3f}s (recorded {expected["duration"]:.3f}s)')
+        return result
+
+recorder = Recorder.from_env()
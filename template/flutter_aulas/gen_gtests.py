@@ -1,7 +1,13 @@
 import os
+import sys
+import json
+import hashlib
+import subprocess
 
 directory = "lib"
 prefix = "g_"
+# content hashes of the lib/g_*.dart files the tests, drafts and goldens were generated from
+manifest_path = ".gen_gtests.json"
 
 # Sample input: see file g_alo_flutter.dart
 
@@ -73,14 +79,56 @@ void main() {
 }
 ''')
 
-def generate_goldens(filename):
-    os.system(f"flutter test --update-goldens test/{filename}_test.dart")
+def generate_goldens(filenames):
+    '''Updates the goldens of all files in a single (parallel) flutter test run.'''
+    if not filenames:
+        return True
+    cmd = ["flutter", "test", "--update-goldens"] + [f"test/{filename}_test.dart" for filename in filenames]
+    return subprocess.run(cmd).returncode == 0
+
+def file_hash(path):
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+def load_manifest():
+    if not os.path.exists(manifest_path):
+        return {}
+    with open(manifest_path, "r") as f:
+        return json.load(f)
+
+def save_manifest(manifest):
+    with open(manifest_path, "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+
+def is_up_to_date(filename, source_hash, manifest):
+    outputs = [f"test/{filename}_test.dart", f"draft/{filename}__draft.dart",
+               f"test/goldens/{filename}01.png", f"test/goldens/{filename}02.png"]
+    return manifest.get("files", {}).get(filename) == source_hash and all(os.path.exists(path) for path in outputs)
 
 if __name__ == "__main__":
+    # use --force to regenerate everything
+    force = "--force" in sys.argv
+    generator_hash = file_hash(__file__)
+    manifest = load_manifest()
+    if force or manifest.get("generator") != generator_hash:
+        # the templates above may have changed
+        manifest = {}
+
     files = [file.replace('.dart', '') for file in os.listdir(directory) if file.startswith(prefix) and not '__draft' in file]
 
+    hashes = {}
+    changed = []
     for filename in files:
+        hashes[filename] = file_hash(f"{directory}/{filename}.dart")
+        if is_up_to_date(filename, hashes[filename], manifest):
+            continue
         print(filename)
         generate_test_file(filename)
         generate_draft_file(filename)
-        generate_goldens(filename)
+        changed.append(filename)
+
+    if not generate_goldens(changed):
+        print("flutter test --update-goldens failed; these files will be regenerated next time:", ", ".join(changed))
+        hashes = {filename: h for filename, h in hashes.items() if filename not in changed}
+    print(f"{len(changed)} of {len(files)} files regenerated")
+    save_manifest({"generator": generator_hash, "files": hashes})
@@ -0,0 +1,84 @@
+import unittest
+from dedup import canonical_python, canonical_blocomp
+
+TESTCODE = 'assert soma(1, 2) == 3'
+
+def same(a, b):
+    return canonical_python(a) == canonical_python(b)
+
+class CanonicalPythonTest(unittest.TestCase):
+    def test_ignores_whitespace_and_comments(self):
+        self.assertTrue(same('print(1 + 2)  # soma', 'print( 1+2 )\n\n'))
+
+    def test_renames_function_locals(self):
+        self.assertTrue(same(
+            'def soma(a, b):\n    total = a + b\n    return total\n' + TESTCODE,
+            'def soma(x, y):\n    r = x + y\n    return r\n' + TESTCODE))
+
+    def test_renames_closure_variables(self):
+        self.assertTrue(same(
+            'def f():\n    x = 1\n    def g():\n        return x\n    return g()\nprint(f())',
+            'def f():\n    y = 1\n    def g():\n        return y\n    return g()\nprint(f())'))
+
+    def test_keeps_module_level_function_names(self):
+        self.assertFalse(same(
+            'def soma(a, b):\n    return a + b\n' + TESTCODE,
+            'def somar(a, b):\n    return a + b\n' + TESTCODE))
+
+    def test_keeps_module_level_variables(self):
+        self.assertFalse(same('x = input()\nprint(x)', 'y = input()\nprint(y)'))
+
+    def test_main_module_access(self):
+        tests = '\nimport __main__\nassert __main__.soma(1, 2) == 3'
+        self.assertFalse(same('def soma(a, b):\n    return a + b' + tests,
+                              'def somar(a, b):\n    return a + b' + tests))
+
+    def test_doctest(self):
+        tests = '\nimport doctest\ndoctest.testmod()'
+        self.assertFalse(same('def soma(a, b):\n    """\n    >>> soma(1, 2)\n    3\n    """\n    return a + b' + tests,
+                              'def somar(a, b):\n    """\n    >>> soma(1, 2)\n    3\n    """\n    return a + b' + tests))
+
+    def test_introspection_disables_renaming(self):
+        for tests in ('import sys\nprint(sys.modules["__main__"])', 'import inspect\nprint(inspect.stack())',
+                      'print(locals())', 'from __main__ import *'):
+            with self.subTest(tests=tests):
+                self.assertFalse(same('def f(a):\n    return a\n' + tests, 'def f(b):\n    return b\n' + tests))
+
+    def test_local_and_builtin_with_same_spelling(self):
+        self.assertFalse(same(
+            'def f():\n    len = 1\ndef g():\n    return len([])\nprint(g())',
+            'def f():\n    y = 1\ndef g():\n    return y([])\nprint(g())'))
+
+    def test_keeps_keyword_argument_names(self):
+        self.assertFalse(same('def f():\n    def g(a):\n        return a\n    return g(a=1)',
+                              'def f():\n    def g(b):\n        return b\n    return g(a=1)'))
+
+    def test_keeps_class_names(self):
+        enum = 'from enum import Enum\nclass {}(Enum):\n    RED = 1\nprint({}.RED)'
+        self.assertFalse(same(enum.format('Cor', 'Cor'), enum.format('Color', 'Color')))
+        local = 'def f():\n    class {}:\n        pass\n    return {}()\nprint(f())'
+        self.assertFalse(same(local.format('A', 'A'), local.format('B', 'B')))
+
+    def test_keeps_class_members(self):
+        self.assertFalse(same('class A:\n    x = 1\nprint(A.x)', 'class A:\n    y = 1\nprint(A.x)'))
+
+    def test_placeholders_do_not_collide_with_unbound_names(self):
+        self.assertFalse(same('def f():\n    a = 1\n    return v0\nprint(f())',
+                              'def f():\n    v0 = 1\n    return v0\nprint(f())'))
+
+    def test_imports_keep_their_names(self):
+        self.assertFalse(same('def f():\n    import math\n    return math.pi',
+                              'def f():\n    import math\n    m = 1\n    return m.pi'))
+
+    def test_syntax_error(self):
+        self.assertIsNone(canonical_python('def f(:'))
+
+class CanonicalBlocompTest(unittest.TestCase):
+    def test_uses_generated_javascript(self):
+        self.assertEqual(canonical_blocomp('{"xml": "<a/>", "code": {"javascript": "f();"}}'), 'f();')
+
+    def test_invalid_answer(self):
+        self.assertIsNone(canonical_blocomp('not json'))
+
+if __name__ == '__main__':
+    unittest.main()